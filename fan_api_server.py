@@ -4,189 +4,394 @@ Simple HTTP API server for fan control status
 Modeled after beocreate extension patterns
 """
 import json
+import logging
 import os
 import subprocess
-from http.server import HTTPServer, BaseHTTPRequestHandler
-from urllib.parse import urlparse, parse_qs
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs
+
+# Use orjson for JSON encoding/decoding if available, fall back to the standard library
+try:
+    import orjson
+    _dumps = orjson.dumps
+    _loads = orjson.loads
+except ImportError:
+    def _dumps(obj):
+        return json.dumps(obj).encode()
+    _loads = json.loads
+
+# Try to import python-systemd to read the journal without forking journalctl
+try:
+    from systemd import journal
+    JOURNAL_AVAILABLE = True
+except ImportError:
+    JOURNAL_AVAILABLE = False
+
+# Configure logging
+# Set FAN_API_LOG=DEBUG to log every config update
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger('fan_api')
+logger.setLevel(os.environ.get('FAN_API_LOG', 'INFO').upper())
 
 STATUS_FILE = '/opt/hifiberry/fan-control/status.json'
 CONFIG_FILE = '/opt/hifiberry/fan-control/config.json'
 LOG_FILE = '/var/log/fan-control.log'
 
+# Maximum number of requests handled concurrently
+# Can be overridden via environment variable: FAN_API_THREADS=4
+MAX_WORKERS = int(os.environ.get('FAN_API_THREADS', '10'))
+
+# Largest accepted config POST body in bytes (a valid config is ~50 bytes)
+MAX_POST = 4096
+
+# Recent logs are shared between requests for a few seconds so that a
+# polling UI does not fork journalctl on every request
+LOGS_CACHE_TTL = 5.0
+_logs_cache = {'ts': 0.0, 'data': None}
+_logs_lock = threading.Lock()
+logs_cache_hits = 0
+logs_cache_misses = 0
+
+def read_unit_logs(unit, n=50):
+    """Read the last n journal entries of a systemd unit in-process"""
+    reader = journal.Reader(journal.LOCAL_ONLY)
+    try:
+        reader.add_match(_SYSTEMD_UNIT=unit)
+        reader.seek_tail()
+        logs = []
+        while len(logs) < n:
+            entry = reader.get_previous()
+            if not entry:
+                break
+            timestamp = entry.get('__REALTIME_TIMESTAMP')
+            timestamp = timestamp.strftime('%b %d %H:%M:%S') if timestamp else ''
+            logs.append(f"{timestamp} {entry.get('MESSAGE', '')}")
+        logs.reverse()  # Oldest first, like journalctl
+        return logs
+    finally:
+        reader.close()
+
+def tail_file(path, n=50, window=16384):
+    """Return the last n lines of a file, reading only a block from its end"""
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        while True:
+            start = max(0, size - window)
+            f.seek(start)
+            lines = f.read().decode('utf-8', 'replace').splitlines()
+            if start == 0:
+                break
+            # A partial block may start in the middle of a line, so drop it
+            lines = lines[1:]
+            if len(lines) >= n:
+                break
+            window *= 2  # Lines are long, retry with a bigger block
+    return lines[-n:]
+
+def read_logs():
+    """Read the last 50 log lines from the journal, falling back to the log file"""
+    if JOURNAL_AVAILABLE:
+        try:
+            return read_unit_logs('fan-control.service', 50)
+        except Exception:
+            pass  # Fall back to journalctl below
+    
+    logs = []
+    
+    # Try to get logs from journalctl if available
+    try:
+        result = subprocess.run(
+            ['journalctl', '-u', 'fan-control.service', '-n', '50', '--no-pager', '--output=short'],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            timeout=2
+        )
+        if result.returncode == 0:
+            for line in result.stdout.decode('utf-8', 'replace').split('\n'):
+                if line.strip():
+                    logs.append(line)
+    except (FileNotFoundError, subprocess.TimeoutExpired):
+        # Fallback to log file if journalctl not available
+        if os.path.exists(LOG_FILE):
+            logs = tail_file(LOG_FILE, 50)
+    return logs
+
+def get_logs(refresh=False):
+    """Return recent logs, reading them at most once per LOGS_CACHE_TTL seconds"""
+    global logs_cache_hits, logs_cache_misses
+    # Hold the lock while reading so concurrent misses share a single read
+    with _logs_lock:
+        if (not refresh and _logs_cache['data'] is not None
+                and time.monotonic() - _logs_cache['ts'] < LOGS_CACHE_TTL):
+            logs_cache_hits += 1
+            return _logs_cache['data']
+        logs_cache_misses += 1
+        logs = read_logs()
+        _logs_cache['data'] = logs
+        _logs_cache['ts'] = time.monotonic()
+        return logs
+
+# Raw status.json bytes, re-read only when the file's mtime or size changes
+_status_cache = {'key': None, 'body': b''}
+_status_lock = threading.Lock()
+_STATUS_MISSING = _dumps({
+    'temperature': None,
+    'duty_cycle': 0,
+    'pwm_mode': 'unknown',
+    'error': 'Status file not found'
+})
+
+def get_status_body():
+    """Return the status JSON as bytes, served from memory while the file is unchanged"""
+    try:
+        st = os.stat(STATUS_FILE)
+    except FileNotFoundError:
+        return _STATUS_MISSING
+    key = (st.st_mtime_ns, st.st_size)
+    with _status_lock:
+        if _status_cache['key'] != key:
+            with open(STATUS_FILE, 'rb') as f:
+                body = f.read()
+            _loads(body)  # Never cache a partially written file
+            _status_cache['key'] = key
+            _status_cache['body'] = body
+        return _status_cache['body']
+
+# Constant error responses
+_ERR_NO_DATA = _dumps({'success': False, 'error': 'No data provided'})
+_ERR_DUTY_RANGE = _dumps({'success': False, 'error': 'Duty cycle must be between 0 and 100'})
+_ERR_TOO_LARGE = _dumps({'success': False, 'error': 'Request body too large'})
+_ERR_NOT_OBJECT = _dumps({'success': False, 'error': 'Config must be a JSON object'})
+
+# Guards the config cache and serializes writers, which share a temporary file
+_config_lock = threading.Lock()
+
+def _write_atomic(path, data):
+    """Write bytes to a temporary file next to path, then rename it into place"""
+    tmp = path + '.tmp'
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.write(fd, data)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.replace(tmp, path)
+
+# Header blocks shared by every JSON response
+_COMMON_HEADERS = b'Content-Type: application/json\r\nAccess-Control-Allow-Origin: *\r\n'
+_NO_CACHE_HEADER = b'Cache-Control: no-cache\r\n'
+
+def _read_json(path, default):
+    """Read and parse a small JSON file in one read, or return default if missing"""
+    try:
+        with open(path, 'rb') as f:
+            return _loads(f.read())
+    except FileNotFoundError:
+        return default
+
+# Serialized config.json; the file only changes through update_config, so it
+# is read from disk once and then kept in memory
+_config_cache_body = None
+
+def load_config_body():
+    """Read config.json from disk and cache its serialized form"""
+    global _config_cache_body
+    config = _read_json(CONFIG_FILE, {
+        'manual_mode': False,
+        'manual_duty_cycle': 0
+    })
+    body = _dumps(config)
+    with _config_lock:
+        _config_cache_body = body
+    return body
+
 class FanControlHandler(BaseHTTPRequestHandler):
+    # Keep-alive lets the UI's back-to-back requests share a connection, but an
+    # open connection holds a pool worker until it goes idle for `timeout`
+    # seconds. Keep it well below the UI's 2 second poll interval so idle
+    # clients give their worker back between polls
+    protocol_version = 'HTTP/1.1'
+    timeout = 1
+    # Send small responses immediately instead of waiting on delayed ACKs
+    disable_nagle_algorithm = True
+    
+    def _write_json(self, code, body, extra_headers=b''):
+        """Send status line, headers and JSON body with a single write"""
+        head = b'%s %d %s\r\n%sContent-Length: %d\r\nConnection: %s\r\n%s\r\n' % (
+            self.protocol_version.encode(), code, self.responses[code][0].encode(),
+            _COMMON_HEADERS, len(body),
+            b'close' if self.close_connection else b'keep-alive',
+            extra_headers)
+        self.wfile.write(head + body)
+    
     def do_OPTIONS(self):
         """Handle CORS preflight requests"""
         self.send_response(200)
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
         self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        self.send_header('Content-Length', '0')
         self.end_headers()
     
     def do_GET(self):
-        parsed_path = urlparse(self.path)
-        path = parsed_path.path
-        
-        if path == '/api/status':
-            self.send_status()
-        elif path == '/api/logs':
-            self.send_logs()
-        elif path == '/api/config':
-            self.send_config()
-        else:
+        path, _, query = self.path.partition('?')
+        handler = self._GET_ROUTES.get(path)
+        if handler is None:
             self.send_error(404, "Not Found")
+        else:
+            handler(self, query)
     
     def do_POST(self):
-        parsed_path = urlparse(self.path)
-        path = parsed_path.path
-        
-        if path == '/api/config':
-            self.update_config()
-        else:
+        path, _, query = self.path.partition('?')
+        handler = self._POST_ROUTES.get(path)
+        if handler is None:
             self.send_error(404, "Not Found")
+        else:
+            handler(self, query)
     
-    def send_status(self):
+    def send_status(self, query=''):
         """Send current status JSON"""
         try:
-            if os.path.exists(STATUS_FILE):
-                with open(STATUS_FILE, 'r') as f:
-                    status = json.load(f)
-            else:
-                status = {
-                    'temperature': None,
-                    'duty_cycle': 0,
-                    'pwm_mode': 'unknown',
-                    'error': 'Status file not found'
-                }
-            
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            self.wfile.write(json.dumps(status).encode())
+            self._write_json(200, get_status_body())
         except Exception as e:
             self.send_error(500, f"Error reading status: {str(e)}")
     
-    def send_logs(self):
-        """Send recent logs"""
+    def send_logs(self, query=''):
+        """Send recent logs (?refresh=1 bypasses the cache)"""
         try:
-            logs = []
-            
-            # Try to get logs from journalctl if available
-            try:
-                result = subprocess.run(
-                    ['journalctl', '-u', 'fan-control.service', '-n', '50', '--no-pager'],
-                    capture_output=True,
-                    text=True,
-                    timeout=2
-                )
-                if result.returncode == 0:
-                    for line in result.stdout.split('\n'):
-                        if line.strip():
-                            logs.append(line)
-            except (FileNotFoundError, subprocess.TimeoutExpired):
-                # Fallback to log file if journalctl not available
-                if os.path.exists(LOG_FILE):
-                    with open(LOG_FILE, 'r') as f:
-                        logs = f.readlines()[-50:]  # Last 50 lines
-            
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            self.wfile.write(json.dumps({'logs': logs}).encode())
+            refresh = bool(query) and parse_qs(query).get('refresh', ['0'])[0] == '1'
+            logs = get_logs(refresh)
+            self._write_json(200, _dumps({'logs': logs}))
         except Exception as e:
             self.send_error(500, f"Error reading logs: {str(e)}")
     
-    def send_config(self):
+    def send_config(self, query=''):
         """Send current configuration"""
         try:
-            if os.path.exists(CONFIG_FILE):
-                with open(CONFIG_FILE, 'r') as f:
-                    config = json.load(f)
-            else:
-                config = {
-                    'manual_mode': False,
-                    'manual_duty_cycle': 0
-                }
-            
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.send_header('Cache-Control', 'no-cache')
-            self.end_headers()
-            self.wfile.write(json.dumps(config).encode())
+            body = _config_cache_body
+            if body is None:
+                body = load_config_body()
+            self._write_json(200, body, _NO_CACHE_HEADER)
         except Exception as e:
             self.send_error(500, f"Error reading config: {str(e)}")
     
-    def update_config(self):
+    def update_config(self, query=''):
         """Update configuration from POST request"""
+        global _config_cache_body
         try:
-            content_length = int(self.headers.get('Content-Length', 0))
-            if content_length == 0:
-                self.send_response(400)
-                self.send_header('Content-Type', 'application/json')
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.end_headers()
-                self.wfile.write(json.dumps({'success': False, 'error': 'No data provided'}).encode())
+            try:
+                content_length = int(self.headers.get('Content-Length', 0))
+            except ValueError:
+                content_length = -1
+            if content_length <= 0:
+                # Missing, empty or malformed body: nothing sensible to read
+                if content_length < 0:
+                    self.close_connection = True
+                self._write_json(400, _ERR_NO_DATA)
+                return
+            
+            if content_length > MAX_POST:
+                # Refuse before reading so oversized bodies are never buffered
+                self.close_connection = True
+                self._write_json(413, _ERR_TOO_LARGE)
                 return
             
             post_data = self.rfile.read(content_length)
-            config = json.loads(post_data.decode('utf-8'))
+            config = _loads(post_data)
+            if not isinstance(config, dict):
+                self._write_json(400, _ERR_NOT_OBJECT)
+                return
             
-            print(f"Received config update: {config}")  # Debug logging
+            logger.debug("Received config update: %s", config)
             
-            # Validate config
+            # Validate config, keeping only the known keys
+            clean = {}
             if 'manual_mode' in config:
-                config['manual_mode'] = bool(config['manual_mode'])
+                clean['manual_mode'] = bool(config['manual_mode'])
             if 'manual_duty_cycle' in config:
                 duty = int(config['manual_duty_cycle'])
-                if duty < 0 or duty > 100:
-                    self.send_response(400)
-                    self.send_header('Content-Type', 'application/json')
-                    self.send_header('Access-Control-Allow-Origin', '*')
-                    self.end_headers()
-                    self.wfile.write(json.dumps({'success': False, 'error': 'Duty cycle must be between 0 and 100'}).encode())
+                if not 0 <= duty <= 100:
+                    self._write_json(400, _ERR_DUTY_RANGE)
                     return
-                config['manual_duty_cycle'] = duty
+                clean['manual_duty_cycle'] = duty
+            config = clean
             
             # Write config file
-            os.makedirs(os.path.dirname(CONFIG_FILE), exist_ok=True)
-            with open(CONFIG_FILE, 'w') as f:
-                json.dump(config, f)
+            body = _dumps(config)
+            with _config_lock:
+                _write_atomic(CONFIG_FILE, body)
+                _config_cache_body = body
             
-            print(f"Config saved to {CONFIG_FILE}")  # Debug logging
+            logger.debug("Config saved to %s", CONFIG_FILE)
             
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            self.wfile.write(json.dumps({'success': True, 'config': config}).encode())
+            self._write_json(200, _dumps({'success': True, 'config': config}))
         except json.JSONDecodeError as e:
-            print(f"JSON decode error: {e}")
-            self.send_response(400)
-            self.send_header('Content-Type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            self.wfile.write(json.dumps({'success': False, 'error': f'Invalid JSON: {str(e)}'}).encode())
+            logger.warning("JSON decode error: %s", e)
+            self._write_json(400, _dumps({'success': False, 'error': f'Invalid JSON: {str(e)}'}))
         except Exception as e:
-            print(f"Error updating config: {e}")
-            import traceback
-            traceback.print_exc()
-            self.send_response(500)
-            self.send_header('Content-Type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            self.wfile.write(json.dumps({'success': False, 'error': str(e)}).encode())
+            logger.error("Error updating config: %s", e, exc_info=True)
+            self._write_json(500, _dumps({'success': False, 'error': str(e)}))
     
     def log_message(self, format, *args):
         """Suppress default logging"""
         pass
+    
+    # Fixed route tables, looked up by path without the query string
+    _GET_ROUTES = {
+        '/api/status': send_status,
+        '/api/logs': send_logs,
+        '/api/config': send_config,
+    }
+    _POST_ROUTES = {
+        '/api/config': update_config,
+    }
+
+class FanControlServer(ThreadingHTTPServer):
+    """Threaded HTTP server that dispatches requests to a bounded worker pool"""
+    allow_reuse_address = True  # Rebind right after a restart despite TIME_WAIT
 
-def run(port=8088):
+    def __init__(self, server_address, handler_class, max_workers=MAX_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        super().__init__(server_address, handler_class)
+
+    def process_request(self, request, client_address):
+        # Reuse pool threads instead of spawning one thread per request
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def server_close(self):
+        super().server_close()
+        # Drop queued requests; pool threads are joined at exit, and one busy on
+        # an idle keep-alive connection returns within the handler timeout
+        if sys.version_info >= (3, 9):
+            self.executor.shutdown(wait=False, cancel_futures=True)
+        else:
+            self.executor.shutdown(wait=False)
+
+def run(port=8088, max_workers=MAX_WORKERS):
+    os.makedirs(os.path.dirname(CONFIG_FILE), exist_ok=True)
     server_address = ('', port)
-    httpd = HTTPServer(server_address, FanControlHandler)
-    print(f'Fan Control API server running on port {port}')
-    httpd.serve_forever()
+    httpd = FanControlServer(server_address, FanControlHandler, max_workers)
+    try:
+        load_config_body()
+    except Exception as e:
+        logger.warning("Could not preload config: %s", e)
+    logger.info("Fan Control API server running on port %d (%d workers)", port, max_workers)
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        logger.info("Fan Control API server stopped")
 
 if __name__ == '__main__':
     run()
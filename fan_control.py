@@ -5,10 +5,19 @@ Uses gpiod (libgpiod) if available, falls back to sysfs GPIO interface
 Modeled after HiFiBerry audiocontrol2 powercontroller approach
 """
 import os
+import sys
 import time
+import ctypes
+import ctypes.util
+import functools
+import glob
+import struct
 import logging
 import signal
+import select
 import json
+from dataclasses import dataclass, field
+from typing import Optional
 
 # Try to import gpiod (modern GPIO interface, used by HiFiBerry OS)
 try:
@@ -17,6 +26,23 @@ try:
 except ImportError:
     GPIOD_AVAILABLE = False
 
+# Try to import pigpio (pigpiod generates PWM pulses via DMA, no Python loop)
+try:
+    import pigpio
+    PIGPIO_AVAILABLE = True
+except ImportError:
+    PIGPIO_AVAILABLE = False
+
+# Use orjson for JSON encoding/decoding if available, fall back to the standard library
+try:
+    import orjson
+    _dumps = orjson.dumps
+    _loads = orjson.loads
+except ImportError:
+    def _dumps(obj):
+        return json.dumps(obj, separators=(',', ':')).encode()
+    _loads = json.loads
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,  # Use INFO for normal operation, DEBUG for troubleshooting
@@ -30,64 +56,66 @@ logger = logging.getLogger('fan_control')
 GPIO_PIN = int(os.environ.get('GPIO_PIN', '12'))  # Default to GPIO 12 (hardware PWM capable)
 PWM_FREQ = 100  # PWM frequency in Hz
 
-# Global variables for cleanup
-gpio_exported = False
-gpio_line = None  # For gpiod
-pwm_enabled = False
-pwm_path = None
-running = True
-use_gpiod = False
+# PWM channel that drives each BCM GPIO pin
+PWM_CHANNELS = {12: 0, 13: 1, 18: 0, 19: 1}  # BCM2835-BCM2711 (Pi 1-4)
+RP1_PWM_CHANNELS = {12: 0, 13: 1, 14: 2, 15: 3, 18: 2, 19: 3}  # RP1 (Pi 5)
+# PWM0 blocks the channel tables above refer to (device name suffixes),
+# trusted when neither debugfs nor the device tree tell how the pins are muxed
+PWM0_DEVICES = ('20c000.pwm', '1f00098000.pwm')
+
+# Auto mode temperature thresholds in millidegrees Celsius
+# (50 and 40 °C after rounding to whole degrees)
+TEMP_HIGH_MC = 49500  # 100% fan at or above
+TEMP_MEDIUM_MC = 39500  # 85% fan at or above, 60% below
+# Hysteresis: step back down only at 48/38 °C (after rounding), and only once
+# the current fan speed has been held for MIN_DWELL_SECONDS
+TEMP_HYSTERESIS_MC = 1000
+MIN_DWELL_SECONDS = 120.0
+# Longest wait between retries when the temperature cannot be read
+TEMP_RETRY_MAX_DELAY = 60.0
+# In manual mode the temperature is only displayed, so read it every Nth tick
+MANUAL_TEMP_READ_TICKS = 6
 
 # Status and config files for webserver/UI
 STATUS_FILE = '/opt/hifiberry/fan-control/status.json'
 CONFIG_FILE = '/opt/hifiberry/fan-control/config.json'
-current_temp = None
-current_duty_cycle = 0
-pwm_mode = 'unknown'
-
-# Manual override settings
-manual_mode = False
-manual_duty_cycle = 0
-
-def signal_handler(sig, frame):
-    """Handle shutdown signals"""
-    global running
-    logger.info("Received shutdown signal, stopping fan control...")
-    running = False
-
-# Register signal handlers
-signal.signal(signal.SIGTERM, signal_handler)
-signal.signal(signal.SIGINT, signal_handler)
-
-def init_gpiod(pin):
-    """Initialize GPIO using gpiod (modern approach, used by HiFiBerry OS)"""
-    global gpio_line
-    try:
-        chip = gpiod.Chip("/dev/gpiochip0")
-        # Request line as output (offset is BCM pin number on gpiochip0)
-        gpio_line = chip.get_line(pin)
-        gpio_line.request(consumer="fan_control", type=gpiod.LINE_REQ_DIR_OUT)
-        logger.info(f"Initialized GPIO {pin} using gpiod (libgpiod)")
-        return True
-    except Exception as e:
-        logger.warning(f"Failed to initialize GPIO {pin} with gpiod: {e}")
-        return False
+TEMP_PATH = '/sys/class/thermal/thermal_zone0/temp'
 
-def set_gpiod_value(pin, value):
-    """Set GPIO value using gpiod"""
-    global gpio_line
-    try:
-        if gpio_line:
-            gpio_line.set_value(1 if value else 0)
-            return True
-    except Exception as e:
-        logger.error(f"Failed to set GPIO value via gpiod: {e}")
-    return False
+# inotify events signalling that a file in the watched directory was rewritten
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+INOTIFY_EVENT = struct.Struct('iIII')  # wd, mask, cookie, len (name follows)
+
+# Software PWM runs at this SCHED_FIFO priority with its memory locked
+RT_PRIORITY = 10
+MCL_CURRENT = 1
+MCL_FUTURE = 2
+# Software PWM sleeps until absolute CLOCK_MONOTONIC deadlines
+CLOCK_MONOTONIC = 1
+TIMER_ABSTIME = 1
 
+class Timespec(ctypes.Structure):
+    """struct timespec for clock_nanosleep()"""
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+# slots=True needs Python 3.10+, older interpreters get a regular dataclass
+DATACLASS_OPTIONS = {'slots': True} if sys.version_info >= (3, 10) else {}
+
+@functools.lru_cache(maxsize=1)
 def get_gpiochip_base():
     """Get the base GPIO number for the main GPIO chip (usually gpiochip512 on RPi)
     Returns the base number, or None if not found
+    The chip layout is fixed until reboot, so the result is cached
     """
+    # Fast path: the main GPIO chip is normally gpiochip512
+    try:
+        with open('/sys/class/gpio/gpiochip512/base', 'r') as f:
+            if int(f.read().strip()) == 512:
+                logger.debug("Found main GPIO chip base: 512 (from gpiochip512)")
+                return 512
+    except (ValueError, IOError):
+        pass
+    
     try:
         # Look for gpiochip files in /sys/class/gpio/
         for entry in os.listdir('/sys/class/gpio/'):
@@ -176,13 +204,26 @@ def export_gpio(pin):
     logger.debug(f"Failed to export GPIO {pin} (tried sysfs {sysfs_pin} and direct {pin})")
     return False
 
-def find_available_gpio():
-    """Try to find an available GPIO pin by testing common pins"""
-    # List of GPIO pins to try (common GPIOs that are usually available)
-    # Excluding I2C, SPI, UART pins
-    test_pins = [5, 6, 13, 19, 26, 16, 20, 21]  # Common GPIO pins on Raspberry Pi (BCM numbering)
-    
-    logger.info("Scanning for available GPIO pins (BCM numbering)...")
+def probe_gpio_gpiod(test_pins):
+    """Check which pins are unused with a single gpiod chip query
+    Returns the list of unused pins, or None if gpiod could not be used
+    """
+    try:
+        chip = gpiod.Chip("/dev/gpiochip0")
+        try:
+            # is_used() only reads the line info, nothing gets requested
+            available_pins = [pin for pin in test_pins if not chip.get_line(pin).is_used()]
+        finally:
+            chip.close()
+        for pin in available_pins:
+            logger.info(f"GPIO {pin} (BCM) is available!")
+        return available_pins
+    except Exception as e:
+        logger.debug(f"gpiod scan failed, probing via sysfs instead: {e}")
+        return None
+
+def probe_gpio_sysfs(test_pins):
+    """Check which pins can be exported and driven via sysfs"""
     available_pins = []
     
     # Get GPIO chip base for proper numbering
@@ -210,6 +251,20 @@ def find_available_gpio():
         except Exception as e:
             logger.debug(f"Error testing GPIO {pin}: {e}")
             continue
+    return available_pins
+
+def find_available_gpio():
+    """Try to find an available GPIO pin by testing common pins"""
+    # List of GPIO pins to try (common GPIOs that are usually available)
+    # Excluding I2C, SPI, UART pins
+    test_pins = [5, 6, 13, 19, 26, 16, 20, 21]  # Common GPIO pins on Raspberry Pi (BCM numbering)
+    
+    logger.info("Scanning for available GPIO pins (BCM numbering)...")
+    available_pins = None
+    if GPIOD_AVAILABLE:
+        available_pins = probe_gpio_gpiod(test_pins)
+    if available_pins is None:
+        available_pins = probe_gpio_sysfs(test_pins)
     
     if available_pins:
         logger.info(f"Found {len(available_pins)} available GPIO pin(s): {', '.join(map(str, available_pins))}")
@@ -262,426 +317,903 @@ def setup_gpio_output(pin):
         logger.error(f"Failed to set GPIO {pin} as output: {e}")
         return False
 
-def set_gpio_value(pin, value):
-    """Set GPIO pin value (0 or 1)"""
+def get_pin_mux_owner(pin):
+    """Get the device the pin controller has muxed a BCM GPIO pin to
+    Returns the device name (e.g. 'fe20c000.pwm'), '' if the pin is not muxed
+    to a PWM peripheral, or None if unknown (debugfs not mounted)
+    """
+    seen = False
+    for pinmux_file in glob.glob('/sys/kernel/debug/pinctrl/*/pinmux-pins'):
+        try:
+            with open(pinmux_file, 'r') as f:
+                for line in f:
+                    # e.g. "pin 12 (gpio12): fe20c000.pwm (GPIO UNCLAIMED) function pwm0 group gpio12"
+                    # (newer kernels print "device fe20c000.pwm ...")
+                    if line.startswith(f'pin {pin} (gpio{pin}):'):
+                        seen = True
+                        fields = line.split(':', 1)[1].split()
+                        owner = fields[1] if fields[0] == 'device' else fields[0]
+                        if 'pwm' in owner:
+                            return owner
+                        break
+        except (IOError, IndexError):
+            continue
+    return '' if seen else None
+
+def get_dt_pwm_pins(pwmchip_path):
+    """Get the BCM GPIO pins the device tree muxes to a PWM chip
+    Reads the pin groups its pinctrl-0 phandles point to (brcm,pins on
+    BCM283x/BCM2711, pins = "gpioN" on RP1)
+    Returns a set of pins, or None if the device tree does not say
+    """
     try:
-        gpio_num = get_gpio_path(pin)
-        value_path = f'/sys/class/gpio/gpio{gpio_num}/value'
-        with open(value_path, 'w') as f:
-            f.write('1' if value else '0')
-        return True
+        with open(f'{pwmchip_path}/device/of_node/pinctrl-0', 'rb') as f:
+            data = f.read()
+    except IOError:
+        return None
+    phandles = set(struct.unpack(f'>{len(data) // 4}I', data))
+    
+    pins = set()
+    found = False
+    # Pin groups are child nodes of the GPIO/pin controller
+    for phandle_path in glob.glob('/proc/device-tree/**/gpio@*/*/phandle', recursive=True):
+        try:
+            with open(phandle_path, 'rb') as f:
+                if struct.unpack('>I', f.read(4))[0] not in phandles:
+                    continue
+            node = os.path.dirname(phandle_path)
+            found = True
+            if os.path.exists(f'{node}/brcm,pins'):
+                with open(f'{node}/brcm,pins', 'rb') as f:
+                    data = f.read()
+                pins.update(struct.unpack(f'>{len(data) // 4}I', data))
+            elif os.path.exists(f'{node}/pins'):
+                with open(f'{node}/pins', 'rb') as f:
+                    names = f.read().split(b'\0')
+                pins.update(int(name[4:]) for name in names if name.startswith(b'gpio'))
+        except (IOError, ValueError, struct.error):
+            continue
+    return pins if found else None
+
+@functools.lru_cache(maxsize=None)
+def find_hardware_pwm(pin):
+    """Find the PWM chip and channel that drive a BCM GPIO pin
+    Returns (pwmchip_path, channel), or None if no PWM peripheral maps to the pin
+    """
+    owner = get_pin_mux_owner(pin)
+    if owner == '':
+        logger.debug(f"GPIO {pin} is not muxed to a PWM peripheral")
+        return None
+    
+    for pwmchip_path in sorted(glob.glob('/sys/class/pwm/pwmchip*')):
+        try:
+            # Only accept the chip the pin is routed to: from debugfs if mounted,
+            # else from the device tree, else a PWM0 block the tables are for
+            device = os.path.basename(os.path.realpath(f'{pwmchip_path}/device'))
+            if owner is not None:
+                if device != owner:
+                    continue
+            else:
+                dt_pins = get_dt_pwm_pins(pwmchip_path)
+                if dt_pins is not None:
+                    if pin not in dt_pins:
+                        logger.debug(f"{device} is muxed to GPIO {sorted(dt_pins)}, not GPIO {pin}")
+                        continue
+                elif not device.endswith(PWM0_DEVICES):
+                    logger.debug(f"Pin mux unknown, not using {device} for GPIO {pin}")
+                    continue
+            compatible = b''
+            try:
+                with open(f'{pwmchip_path}/device/of_node/compatible', 'rb') as f:
+                    compatible = f.read()
+            except IOError:
+                pass
+            channels = RP1_PWM_CHANNELS if b'rp1' in compatible else PWM_CHANNELS
+            pwm_channel = channels.get(pin)
+            if pwm_channel is None:
+                continue
+            with open(f'{pwmchip_path}/npwm', 'r') as f:
+                npwm = int(f.read().strip())
+            logger.debug(f"PWM chip {pwmchip_path} ({device}) has {npwm} channels")
+            if pwm_channel >= npwm:
+                logger.warning(f"PWM channel {pwm_channel} not available (chip only has {npwm} channels)")
+                continue
+            return pwmchip_path, pwm_channel
+        except (IOError, ValueError) as e:
+            logger.warning(f"Could not read PWM chip info for {pwmchip_path}: {e}")
+    
+    logger.debug(f"No hardware PWM channel found for GPIO {pin}")
+    return None
+
+def init_pigpio(pin):
+    """Connect to pigpiod and let it generate PWM on the pin
+    Returns the pigpio connection, or None if pigpiod is not available
+    """
+    try:
+        pi = pigpio.pi(show_errors=False)  # Failure is logged below, not printed
+        if not pi.connected:
+            logger.debug("pigpiod is not running")
+            return None
+        pi.set_PWM_frequency(pin, PWM_FREQ)
+        logger.info(f"Using pigpiod for PWM on GPIO {pin} ({pi.get_PWM_frequency(pin)}Hz)")
+        return pi
     except Exception as e:
-        logger.error(f"Failed to set GPIO {pin} value: {e}")
-        return False
+        logger.debug(f"Could not use pigpiod for PWM: {e}")
+        return None
 
-def setup_hardware_pwm():
+def temp_to_duty_cycle(temp_mc):
+    """Map a temperature (millidegrees) to the auto mode duty cycle"""
+    if temp_mc >= TEMP_HIGH_MC:
+        return 100
+    elif temp_mc >= TEMP_MEDIUM_MC:
+        return 85
+    return 60
+
+@functools.lru_cache(maxsize=1)
+def get_libc():
+    """Load the C library for the syscalls Python does not wrap"""
+    return ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+
+def enable_realtime():
+    """Run at real-time priority with all memory locked, so other processes and
+    page faults cannot delay the software PWM edges
+    Needs CAP_SYS_NICE and CAP_IPC_LOCK (root has both), keeps normal
+    scheduling otherwise
     """
-    Setup hardware PWM (only works for GPIO 12/18 which are PWM0/PWM1)
-    GPIO 12 is PWM0 channel 0, GPIO 18 is PWM0 channel 1
-    Returns pwm_path if successful, False otherwise
+    try:
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(RT_PRIORITY))
+        logger.info(f"Software PWM running with SCHED_FIFO priority {RT_PRIORITY}")
+    except (AttributeError, OSError) as e:
+        logger.warning(f"Could not enable real-time scheduling, software PWM may jitter: {e}")
+    try:
+        if get_libc().mlockall(MCL_CURRENT | MCL_FUTURE) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        logger.debug("Locked process memory")
+    except (AttributeError, OSError) as e:
+        logger.warning(f"Could not lock process memory: {e}")
+
+@functools.lru_cache(maxsize=1)
+def get_clock_nanosleep():
+    """clock_nanosleep() from libc, or None if it is not available"""
+    try:
+        clock_nanosleep = get_libc().clock_nanosleep
+        clock_nanosleep.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.POINTER(Timespec), ctypes.c_void_p)
+        return clock_nanosleep
+    except (AttributeError, OSError) as e:
+        logger.warning(f"clock_nanosleep not available, software PWM uses time.sleep: {e}")
+        return None
+
+deadline_ts = Timespec()  # Reused by sleep_until()
+
+def sleep_until(deadline_ns):
+    """Sleep until an absolute time.monotonic_ns() deadline
+    Waking up at a fixed clock value means late wake-ups do not add up
+    from one PWM edge to the next
+    """
+    clock_nanosleep = get_clock_nanosleep()
+    if clock_nanosleep is None:
+        remaining_ns = deadline_ns - time.monotonic_ns()
+        if remaining_ns > 0:
+            time.sleep(remaining_ns / 1e9)
+        return
+    deadline_ts.tv_sec, deadline_ts.tv_nsec = divmod(deadline_ns, 1000000000)
+    clock_nanosleep(CLOCK_MONOTONIC, TIMER_ABSTIME, deadline_ts, None)
+
+def init_config_watch():
+    """Watch the config directory with inotify
+    Returns the inotify fd, or None if inotify is not available
     """
     try:
-        # Hardware PWM only available for GPIO 12 (PWM0 channel 0) and GPIO 18 (PWM0 channel 1)
-        if GPIO_PIN == 12:
-            pwmchip_path = '/sys/class/pwm/pwmchip0'
-            pwm_channel = 0
-        elif GPIO_PIN == 18:
-            pwmchip_path = '/sys/class/pwm/pwmchip0'
-            pwm_channel = 1
-        else:
-            logger.debug(f"Hardware PWM not available for GPIO {GPIO_PIN} (only GPIO 12 and 18 support hardware PWM)")
+        libc = get_libc()
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        # Watch the directory, not the file: config updates replace the file
+        config_dir = os.path.dirname(CONFIG_FILE).encode()
+        if libc.inotify_add_watch(fd, config_dir, IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            err = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(err, os.strerror(err))
+        logger.debug(f"Watching {CONFIG_FILE} for changes")
+        return fd
+    except Exception as e:
+        logger.warning(f"inotify not available, polling config file instead: {e}")
+        return None
+
+def default_status():
+    """Initial status dict for the webserver/UI"""
+    return {
+        'temperature': None,
+        'duty_cycle': 0,
+        'pwm_mode': 'unknown',
+        'gpio_pin': None,
+        'manual_mode': False,
+        'manual_duty_cycle': None,
+        'last_update': None,
+        'error': None
+    }
+
+@dataclass(**DATACLASS_OPTIONS)
+class FanController:
+    """Fan control service state: GPIO/PWM setup, main loop and cleanup
+    Use as a context manager: entering sets up the GPIO, exiting releases it
+    """
+    gpio_pin: int = GPIO_PIN
+    running: bool = True
+
+    # GPIO/PWM state, released on exit
+    gpio_exported: bool = False
+    sysfs_gpio_num: Optional[int] = None  # sysfs number of the exported pin
+    value_fd: Optional[int] = None  # Open sysfs value file of the exported pin
+    gpio_line: object = None  # For gpiod
+    pwm_enabled: bool = False
+    pwm_path: Optional[str] = None
+    use_hardware_pwm: bool = False
+    use_gpiod: bool = False
+    pigpio_pi: object = None  # Connection to pigpiod, used for software PWM if available
+
+    # Self-pipe for interruptible waits: Python writes a byte to it whenever a
+    # signal arrives, which wakes up the select() in wait()
+    wakeup_r: Optional[int] = None
+    wakeup_w: Optional[int] = None
+    config_watch_fd: Optional[int] = None  # inotify fd watching CONFIG_FILE, None if unavailable
+    config_changed: bool = True  # Read the config on the first iteration
+
+    # Cached sysfs file descriptors (closed on exit)
+    temp_fd: Optional[int] = None
+    duty_fd: Optional[int] = None  # Hardware PWM duty_cycle, opened by setup_hardware_pwm
+    duty_ns_table: Optional[list] = None  # duty_cycle value (bytes) for each 0-100% duty cycle
+
+    current_temp: Optional[float] = None
+    current_duty_cycle: int = 0
+    pwm_mode: str = 'unknown'
+    last_status_payload: Optional[tuple] = None  # Status fields last written, minus last_update
+    # Status dict for the webserver/UI, updated in place by update_status_file
+    status: dict = field(default_factory=default_status)
+    last_dc: Optional[int] = None  # Duty cycle last written to the PWM peripheral
+    temp_retry_delay: float = 1.0  # Doubles on each failed temperature read
+    tick: int = 0  # Main loop iterations
+    last_temp_mc: Optional[int] = None  # Last temperature read, reused in manual mode
+
+    # Auto mode state for hysteresis
+    auto_dc: Optional[int] = None  # Current auto mode duty cycle
+    auto_dc_since: float = 0.0  # time.monotonic() of the last auto_dc change
+
+    # Manual override settings
+    manual_mode: bool = False
+    manual_duty_cycle: int = 0
+
+    def __enter__(self):
+        # Register signal handlers
+        # Interrupted system calls (e.g. sysfs writes) are restarted by the kernel;
+        # wait() is woken up through the wakeup fd instead
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, self.signal_handler)
+            signal.siginterrupt(sig, False)
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        os.set_blocking(self.wakeup_r, False)
+        os.set_blocking(self.wakeup_w, False)
+        signal.set_wakeup_fd(self.wakeup_w)
+
+        if not self.setup_gpio():
+            exit(1)
+        if not self.use_hardware_pwm and not self.pigpio_pi:
+            # The PWM pulses are timed by the main loop itself
+            enable_realtime()
+        logger.info("Fan control service started")
+
+        self.update_status_file(None, 0, self.pwm_mode, "Initializing...")
+        self.config_watch_fd = init_config_watch()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.cleanup()
+        return False
+
+    def signal_handler(self, sig, frame):
+        """Handle shutdown signals"""
+        logger.info("Received shutdown signal, stopping fan control...")
+        self.running = False
+
+    def wait(self, seconds):
+        """Sleep for up to the given seconds, returning early on a signal
+        or when the config file changes
+        """
+        wakeup_r = self.wakeup_r
+        config_watch_fd = self.config_watch_fd
+        fds = [wakeup_r] if config_watch_fd is None else [wakeup_r, config_watch_fd]
+        deadline = time.monotonic() + seconds
+        while self.running:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            ready, _, _ = select.select(fds, [], [], remaining)
+            if not ready:
+                return
+            if wakeup_r in ready:
+                try:
+                    os.read(wakeup_r, 512)  # Drain the wakeup bytes
+                except BlockingIOError:
+                    pass
+                return
+            if config_watch_fd in ready and self.read_config_events():
+                self.config_changed = True
+                return
+
+    def init_gpiod(self, pin):
+        """Initialize GPIO using gpiod (modern approach, used by HiFiBerry OS)"""
+        try:
+            chip = gpiod.Chip("/dev/gpiochip0")
+            # Request line as output (offset is BCM pin number on gpiochip0)
+            self.gpio_line = chip.get_line(pin)
+            self.gpio_line.request(consumer="fan_control", type=gpiod.LINE_REQ_DIR_OUT)
+            logger.info(f"Initialized GPIO {pin} using gpiod (libgpiod)")
+            return True
+        except Exception as e:
+            logger.warning(f"Failed to initialize GPIO {pin} with gpiod: {e}")
             return False
-        
-        if not os.path.exists(pwmchip_path):
-            logger.debug(f"Hardware PWM chip0 not found at {pwmchip_path}")
+
+    def open_gpio_value(self):
+        """Resolve the sysfs number of the exported pin once and keep its
+        value file open, so set_gpio_value() is a single write
+        """
+        try:
+            self.sysfs_gpio_num = get_gpio_path(self.gpio_pin)
+            self.value_fd = os.open(f'/sys/class/gpio/gpio{self.sysfs_gpio_num}/value', os.O_WRONLY)
+            return True
+        except OSError as e:
+            logger.error(f"Failed to open GPIO {self.gpio_pin} value: {e}")
             return False
-        
-        # Check if we can access the chip
+
+    def set_gpio_value(self, pin, value):
+        """Set GPIO pin value (0 or 1) via sysfs"""
         try:
-            with open(f'{pwmchip_path}/npwm', 'r') as f:
-                npwm = int(f.read().strip())
-                logger.debug(f"PWM chip has {npwm} channels")
-                if pwm_channel >= npwm:
-                    logger.warning(f"PWM channel {pwm_channel} not available (chip only has {npwm} channels)")
-                    return False
+            os.pwrite(self.value_fd, b'1' if value else b'0', 0)
+            return True
         except Exception as e:
-            logger.warning(f"Could not read PWM chip info: {e}")
+            logger.error(f"Failed to set GPIO {pin} value: {e}")
             return False
-        
-        pwm_path = f'{pwmchip_path}/pwm{pwm_channel}'
-        
-        # Export PWM channel
-        if not os.path.exists(pwm_path):
-            try:
-                logger.debug(f"Exporting PWM channel {pwm_channel}")
-                with open(f'{pwmchip_path}/export', 'w') as f:
-                    f.write(str(pwm_channel))
-                time.sleep(0.2)  # Give it more time to create
-                
-                # Verify it was created
-                if not os.path.exists(pwm_path):
-                    logger.warning(f"PWM channel {pwm_channel} export succeeded but path not created")
+
+    def set_gpiod_value(self, pin, value):
+        """Set GPIO value using gpiod"""
+        try:
+            if self.gpio_line:
+                self.gpio_line.set_value(1 if value else 0)
+                return True
+        except Exception as e:
+            logger.error(f"Failed to set GPIO value via gpiod: {e}")
+        return False
+
+    def setup_hardware_pwm(self):
+        """
+        Setup hardware PWM for the fan pin if a PWM peripheral drives it
+        (GPIO 12/18 are PWM0, GPIO 13/19 are PWM1)
+        Returns pwm_path if successful, False otherwise
+        """
+        try:
+            pwm = find_hardware_pwm(self.gpio_pin)
+            if not pwm:
+                return False
+            pwmchip_path, pwm_channel = pwm
+
+            pwm_path = f'{pwmchip_path}/pwm{pwm_channel}'
+
+            # Export PWM channel
+            if not os.path.exists(pwm_path):
+                try:
+                    logger.debug(f"Exporting PWM channel {pwm_channel}")
+                    with open(f'{pwmchip_path}/export', 'w') as f:
+                        f.write(str(pwm_channel))
+                    time.sleep(0.2)  # Give it more time to create
+
+                    # Verify it was created
+                    if not os.path.exists(pwm_path):
+                        logger.warning(f"PWM channel {pwm_channel} export succeeded but path not created")
+                        return False
+                except (IOError, PermissionError) as e:
+                    logger.warning(f"Failed to export PWM channel {pwm_channel}: {e}")
                     return False
-            except (IOError, PermissionError) as e:
-                logger.warning(f"Failed to export PWM channel {pwm_channel}: {e}")
+                except Exception as e:
+                    logger.warning(f"Unexpected error exporting PWM channel: {e}")
+                    return False
+            else:
+                logger.debug(f"PWM channel {pwm_channel} already exists")
+
+            # Set period (1/frequency in nanoseconds)
+            period_ns = int(1000000000 / PWM_FREQ)  # Convert Hz to nanoseconds
+            try:
+                with open(f'{pwm_path}/period', 'w') as f:
+                    f.write(str(period_ns))
+                logger.debug(f"Set PWM period to {period_ns}ns ({PWM_FREQ}Hz)")
+            except Exception as e:
+                logger.warning(f"Failed to set PWM period: {e}")
                 return False
+
+            # Enable PWM
+            try:
+                with open(f'{pwm_path}/enable', 'w') as f:
+                    f.write('1')
+                logger.debug(f"Enabled hardware PWM")
             except Exception as e:
-                logger.warning(f"Unexpected error exporting PWM channel: {e}")
+                logger.warning(f"Failed to enable PWM: {e}")
                 return False
-        else:
-            logger.debug(f"PWM channel {pwm_channel} already exists")
-        
-        # Set period (1/frequency in nanoseconds)
-        period_ns = int(1000000000 / PWM_FREQ)  # Convert Hz to nanoseconds
+
+            # Keep duty_cycle open and precompute its value for every 0-100% duty
+            # cycle, so an update is a single write with no arithmetic
+            try:
+                self.duty_ns_table = [str(period_ns * i // 100).encode() for i in range(101)]
+                self.duty_fd = os.open(f'{pwm_path}/duty_cycle', os.O_WRONLY)
+            except Exception as e:
+                logger.warning(f"Failed to open PWM duty cycle: {e}")
+                return False
+
+            logger.info(f"Hardware PWM enabled on {pwm_path}")
+            return pwm_path
+
+        except Exception as e:
+            logger.warning(f"Hardware PWM setup failed: {e}")
+            return False
+
+    def set_hardware_pwm_duty_cycle(self, duty_cycle_percent):
+        """Set hardware PWM duty cycle (0-100%)"""
         try:
-            with open(f'{pwm_path}/period', 'w') as f:
-                f.write(str(period_ns))
-            logger.debug(f"Set PWM period to {period_ns}ns ({PWM_FREQ}Hz)")
+            os.pwrite(self.duty_fd, self.duty_ns_table[duty_cycle_percent], 0)
+            return True
         except Exception as e:
-            logger.warning(f"Failed to set PWM period: {e}")
+            logger.error(f"Failed to set PWM duty cycle: {e}")
             return False
-        
-        # Enable PWM
+
+    def set_pigpio_duty_cycle(self, pin, duty_cycle_percent):
+        """Set the duty cycle (0-100%) of the PWM generated by pigpiod"""
         try:
-            with open(f'{pwm_path}/enable', 'w') as f:
-                f.write('1')
-            logger.debug(f"Enabled hardware PWM")
+            self.pigpio_pi.set_PWM_dutycycle(pin, duty_cycle_percent * 255 // 100)
+            return True
         except Exception as e:
-            logger.warning(f"Failed to enable PWM: {e}")
+            logger.error(f"Failed to set pigpio duty cycle: {e}")
             return False
-        
-        logger.info(f"Hardware PWM enabled on {pwm_path}")
-        return pwm_path
-        
-    except Exception as e:
-        logger.warning(f"Hardware PWM setup failed: {e}")
-        return False
 
-def set_hardware_pwm_duty_cycle(pwm_path, duty_cycle_percent):
-    """Set hardware PWM duty cycle (0-100%)"""
-    try:
-        # Read period
-        with open(f'{pwm_path}/period', 'r') as f:
-            period_ns = int(f.read().strip())
-        
-        # Calculate duty cycle in nanoseconds
-        duty_ns = int(period_ns * duty_cycle_percent / 100.0)
-        
-        # Set duty cycle
-        with open(f'{pwm_path}/duty_cycle', 'w') as f:
-            f.write(str(duty_ns))
-        
-        return True
-    except Exception as e:
-        logger.error(f"Failed to set PWM duty cycle: {e}")
-        return False
+    def pwm_loop(self, set_value, pin, duty_cycle_percent, duration_seconds):
+        """Toggle the pin with set_value() at PWM_FREQ for duration_seconds
+        Each edge has an absolute deadline, so the frequency stays exact even
+        when single edges are late
+        Returns early (with the pin low) when the config file changes
+        """
+        period_ns = 1000000000 // PWM_FREQ
+        on_time_ns = period_ns * duty_cycle_percent // 100
+        off_time_ns = period_ns - on_time_ns
 
-def gpiod_software_pwm(pin, duty_cycle_percent, duration_seconds):
-    """Software PWM using gpiod (more efficient than sysfs)"""
-    if duty_cycle_percent == 0:
-        set_gpiod_value(pin, 0)
-        time.sleep(duration_seconds)
-        return
-    elif duty_cycle_percent == 100:
-        set_gpiod_value(pin, 1)
-        time.sleep(duration_seconds)
-        return
-    
-    period_ms = 1000.0 / PWM_FREQ
-    on_time_ms = period_ms * (duty_cycle_percent / 100.0)
-    off_time_ms = period_ms - on_time_ms
-    
-    end_time = time.time() + duration_seconds
-    
-    while time.time() < end_time and running:
-        set_gpiod_value(pin, 1)
-        time.sleep(on_time_ms / 1000.0)
-        set_gpiod_value(pin, 0)
-        time.sleep(off_time_ms / 1000.0)
+        next_edge = time.monotonic_ns()
+        end_time = next_edge + int(duration_seconds * 1e9)
+        cycles = 0
 
-def software_pwm(pin, duty_cycle_percent, duration_seconds):
-    """
-    Software PWM using sysfs GPIO
-    This is less efficient but works when hardware PWM isn't available
-    """
-    if duty_cycle_percent == 0:
-        set_gpio_value(pin, 0)
-        time.sleep(duration_seconds)
-        return
-    elif duty_cycle_percent == 100:
-        set_gpio_value(pin, 1)
-        time.sleep(duration_seconds)
-        return
-    
-    period_ms = 1000.0 / PWM_FREQ  # Period in milliseconds
-    on_time_ms = period_ms * (duty_cycle_percent / 100.0)
-    off_time_ms = period_ms - on_time_ms
-    
-    end_time = time.time() + duration_seconds
-    
-    while time.time() < end_time and running:
-        set_gpio_value(pin, 1)
-        time.sleep(on_time_ms / 1000.0)
-        set_gpio_value(pin, 0)
-        time.sleep(off_time_ms / 1000.0)
-
-# Initialize GPIO
-logger.info(f"Initializing GPIO pin {GPIO_PIN}...")
-
-# Try gpiod first (modern approach, used by HiFiBerry audiocontrol2)
-if GPIOD_AVAILABLE:
-    logger.debug("Attempting GPIO initialization with gpiod (libgpiod)...")
-    if init_gpiod(GPIO_PIN):
-        use_gpiod = True
-        gpio_setup_success = True
-        logger.info(f"Using gpiod for GPIO {GPIO_PIN}")
-    else:
-        logger.warning("gpiod initialization failed, falling back to sysfs GPIO")
-        use_gpiod = False
+        while next_edge < end_time and self.running:
+            # wait() is not used here, so look for config changes once a second
+            cycles += 1
+            if cycles >= PWM_FREQ:
+                cycles = 0
+                if self.config_event_pending():
+                    self.config_changed = True
+                    return
+            # After a long stall, restart the cycle instead of catching up in a burst
+            now = time.monotonic_ns()
+            if now - next_edge > period_ns:
+                next_edge = now
+            set_value(pin, 1)
+            next_edge += on_time_ns
+            sleep_until(next_edge)
+            set_value(pin, 0)
+            next_edge += off_time_ns
+            sleep_until(next_edge)
+
+    def gpiod_software_pwm(self, pin, duty_cycle_percent, duration_seconds):
+        """Software PWM using gpiod (more efficient than sysfs)"""
+        if duty_cycle_percent == 0:
+            self.set_gpiod_value(pin, 0)
+            self.wait(duration_seconds)
+            return
+        elif duty_cycle_percent == 100:
+            self.set_gpiod_value(pin, 1)
+            self.wait(duration_seconds)
+            return
+
+        self.pwm_loop(self.set_gpiod_value, pin, duty_cycle_percent, duration_seconds)
+
+    def software_pwm(self, pin, duty_cycle_percent, duration_seconds):
+        """
+        Software PWM using sysfs GPIO
+        This is less efficient but works when hardware PWM isn't available
+        """
+        if duty_cycle_percent == 0:
+            self.set_gpio_value(pin, 0)
+            self.wait(duration_seconds)
+            return
+        elif duty_cycle_percent == 100:
+            self.set_gpio_value(pin, 1)
+            self.wait(duration_seconds)
+            return
+
+        self.pwm_loop(self.set_gpio_value, pin, duty_cycle_percent, duration_seconds)
+
+    def setup_gpio(self):
+        """Set up hardware PWM, pigpiod, gpiod or sysfs GPIO for the fan pin
+        Returns True if one of them worked
+        """
+        logger.info(f"Initializing GPIO pin {self.gpio_pin}...")
 
-# Fall back to sysfs GPIO if gpiod not available or failed
-if not use_gpiod:
-    logger.debug("Using sysfs GPIO interface...")
-    if not os.path.exists('/sys/class/gpio/export'):
-        logger.error("GPIO sysfs interface not available!")
-        logger.error("Both gpiod and sysfs GPIO interfaces are unavailable.")
-        gpio_setup_success = False
-    else:
-        # For GPIO 12/18, try hardware PWM first (since they might be reserved for PWM)
-        # If hardware PWM fails or GPIO is not 12/18, then try to export via sysfs
-        gpio_exported = False
         gpio_setup_success = False
-        
-        # Try to setup hardware PWM first (only for GPIO 12 or 18, and only if PWM is available)
-        logger.debug(f"Attempting hardware PWM setup for GPIO {GPIO_PIN}...")
-        pwm_path = setup_hardware_pwm()
-        if pwm_path:
-            pwm_enabled = True
-            use_hardware_pwm = True
-            pwm_mode = 'hardware'
+
+        # Try hardware PWM first: the SoC PWM peripheral needs no CPU time at all
+        logger.debug(f"Attempting hardware PWM setup for GPIO {self.gpio_pin}...")
+        self.pwm_path = self.setup_hardware_pwm()
+        if self.pwm_path:
+            self.pwm_enabled = True
+            self.use_hardware_pwm = True
+            self.pwm_mode = 'hardware'
             gpio_setup_success = True
-            logger.info(f"Using hardware PWM for GPIO {GPIO_PIN} (no sysfs export needed)")
+            logger.info(f"Using hardware PWM for GPIO {self.gpio_pin} (no GPIO export needed)")
+        elif self.gpio_pin in PWM_CHANNELS:
+            logger.info(f"Hardware PWM not available for GPIO {self.gpio_pin}, using software PWM instead")
+
+        # Then pigpiod, which times the pulses via DMA instead of a Python loop
+        if not self.pwm_path and PIGPIO_AVAILABLE:
+            self.pigpio_pi = init_pigpio(self.gpio_pin)
+            if self.pigpio_pi:
+                self.pwm_mode = 'pigpio'
+                gpio_setup_success = True
+
+        # Then gpiod (modern approach, used by HiFiBerry audiocontrol2)
+        if not self.pwm_path and not self.pigpio_pi and GPIOD_AVAILABLE:
+            logger.debug("Attempting GPIO initialization with gpiod (libgpiod)...")
+            if self.init_gpiod(self.gpio_pin):
+                self.use_gpiod = True
+                gpio_setup_success = True
+                logger.info(f"Using gpiod for GPIO {self.gpio_pin}")
+            else:
+                logger.warning("gpiod initialization failed, falling back to sysfs GPIO")
+                self.use_gpiod = False
+
+        # Fall back to sysfs GPIO if gpiod not available or failed
+        if not self.pwm_path and not self.pigpio_pi and not self.use_gpiod:
+            gpio_setup_success = self.setup_sysfs_gpio()
+
+        # If neither method worked, explain what to check
+        if not gpio_setup_success:
+            self.log_setup_failure()
+            return False
+
+        # Hardware PWM and pigpiod setup were already attempted above
+        # If both failed, the main loop generates software PWM on the GPIO
+        if not self.pwm_path and not self.pigpio_pi:
+            self.use_hardware_pwm = False
+            self.pwm_mode = 'software'
+            if self.gpio_exported:
+                logger.info("Using software PWM (hardware PWM not available, using sysfs GPIO)")
+            else:
+                # Neither hardware PWM nor GPIO export worked
+                # This should not happen as we check gpio_setup_success above, but handle it anyway
+                logger.warning("Neither hardware PWM nor GPIO export available - service may not function correctly")
+        return True
+
+    def setup_sysfs_gpio(self):
+        """Export the fan pin (or the first free one) via the legacy sysfs GPIO
+        interface, only used when neither hardware PWM nor gpiod work
+        Returns True if the pin was exported and set up as an output
+        """
+        logger.debug("Using sysfs GPIO interface...")
+        if not os.path.exists('/sys/class/gpio/export'):
+            logger.error("GPIO sysfs interface not available!")
+            logger.error("Both gpiod and sysfs GPIO interfaces are unavailable.")
         else:
-            if GPIO_PIN in [12, 18]:
-                logger.debug("Hardware PWM setup failed. Checking if PWM chip exists...")
-                # Check if PWM chip exists
-                if os.path.exists('/sys/class/pwm/pwmchip0'):
-                    logger.warning("PWM chip exists but setup failed. This may be normal if PWM is not enabled in kernel.")
-                else:
-                    logger.info("PWM chip0 not found - hardware PWM not available in this kernel. Using sysfs GPIO instead.")
-            
-            # Hardware PWM not available, try sysfs GPIO export
-            logger.debug(f"Attempting sysfs GPIO export for GPIO {GPIO_PIN}...")
-            if export_gpio(GPIO_PIN):
-                gpio_exported = True
-                if setup_gpio_output(GPIO_PIN):
-                    gpio_setup_success = True
-                    logger.info(f"GPIO {GPIO_PIN} exported and configured via sysfs")
+            # Try sysfs GPIO export
+            logger.debug(f"Attempting sysfs GPIO export for GPIO {self.gpio_pin}...")
+            if export_gpio(self.gpio_pin):
+                self.gpio_exported = True
+                if setup_gpio_output(self.gpio_pin) and self.open_gpio_value():
+                    logger.info(f"GPIO {self.gpio_pin} exported and configured via sysfs")
+                    return True
                 else:
-                    logger.error(f"Failed to setup GPIO {GPIO_PIN} as output")
-                    unexport_gpio(GPIO_PIN)
+                    logger.error(f"Failed to setup GPIO {self.gpio_pin} as output")
+                    unexport_gpio(self.gpio_pin)
             else:
-                logger.warning(f"GPIO {GPIO_PIN} export failed. Attempting to find available GPIO pin...")
+                logger.warning(f"GPIO {self.gpio_pin} export failed. Attempting to find available GPIO pin...")
                 # Try to find an available GPIO
                 available_gpio = find_available_gpio()
                 if available_gpio:
                     logger.warning(f"Switching to GPIO {available_gpio} which is available")
-                    GPIO_PIN = available_gpio
-                    if export_gpio(GPIO_PIN):
-                        gpio_exported = True
-                        if setup_gpio_output(GPIO_PIN):
-                            gpio_setup_success = True
-                            logger.info(f"GPIO {GPIO_PIN} exported and configured via sysfs (auto-selected)")
+                    self.gpio_pin = available_gpio
+                    if export_gpio(self.gpio_pin):
+                        self.gpio_exported = True
+                        if setup_gpio_output(self.gpio_pin) and self.open_gpio_value():
+                            logger.info(f"GPIO {self.gpio_pin} exported and configured via sysfs (auto-selected)")
+                            return True
                         else:
-                            logger.error(f"Failed to setup GPIO {GPIO_PIN} as output")
-                            unexport_gpio(GPIO_PIN)
+                            logger.error(f"Failed to setup GPIO {self.gpio_pin} as output")
+                            unexport_gpio(self.gpio_pin)
                 else:
-                    if GPIO_PIN in [12, 18]:
-                        logger.warning(f"GPIO {GPIO_PIN} export failed - this pin is reserved for PWM.")
+                    if self.gpio_pin in PWM_CHANNELS:
+                        logger.warning(f"GPIO {self.gpio_pin} export failed - this pin is reserved for PWM.")
                     else:
-                        logger.error(f"GPIO {GPIO_PIN} export failed and no alternative GPIO found.")
+                        logger.error(f"GPIO {self.gpio_pin} export failed and no alternative GPIO found.")
+        return False
 
-# If neither method worked, exit with helpful message
-if not gpio_setup_success:
-    logger.error("=" * 60)
-    logger.error(f"FAILED TO INITIALIZE GPIO")
-    logger.error("=" * 60)
-    if not os.path.exists('/sys/class/gpio/export'):
-        logger.error("GPIO sysfs interface not available at /sys/class/gpio/export")
-        logger.error("This HiFiBerry OS system may not support legacy sysfs GPIO interface")
-        logger.error("")
-        logger.error("Possible solutions:")
-        logger.error("1. Check if gpiod/libgpiod tools are available:")
-        logger.error("   which gpioset")
-        logger.error("   gpioinfo")
-        logger.error("2. HiFiBerry OS may require different GPIO access method")
-        logger.error("3. Check HiFiBerry OS documentation for GPIO usage")
-    else:
-        if GPIO_PIN in [12, 18]:
-            logger.error(f"GPIO {GPIO_PIN} cannot be exported via sysfs (reserved for PWM)")
-            logger.error("Hardware PWM setup also failed (PWM not available in kernel)")
+    def log_setup_failure(self):
+        """Log why the GPIO could not be initialized, with hints to fix it"""
+        logger.error("=" * 60)
+        logger.error(f"FAILED TO INITIALIZE GPIO")
+        logger.error("=" * 60)
+        if not os.path.exists('/sys/class/gpio/export'):
+            logger.error("GPIO sysfs interface not available at /sys/class/gpio/export")
+            logger.error("This HiFiBerry OS system may not support legacy sysfs GPIO interface")
+            logger.error("")
+            logger.error("Possible solutions:")
+            logger.error("1. Check if gpiod/libgpiod tools are available:")
+            logger.error("   which gpioset")
+            logger.error("   gpioinfo")
+            logger.error("2. HiFiBerry OS may require different GPIO access method")
+            logger.error("3. Check HiFiBerry OS documentation for GPIO usage")
         else:
-            logger.error(f"GPIO {GPIO_PIN} export failed")
-        logger.error("")
-        logger.error("Possible solutions:")
-        logger.error(f"1. Check if another service is using GPIO {GPIO_PIN}")
-        logger.error("2. Verify GPIO pin is available: gpioinfo (if gpiod tools installed)")
-        logger.error("3. Check /sys/kernel/debug/gpio for GPIO status")
-        logger.error("")
-        logger.error("To test GPIO manually:")
-        logger.error(f"  echo {GPIO_PIN} > /sys/class/gpio/export")
-        logger.error(f"  ls -la /sys/class/gpio/gpio{GPIO_PIN}")
-    logger.error("=" * 60)
-    exit(1)
-
-# Hardware PWM setup was already attempted above
-# If it failed and GPIO was exported, set up for software PWM
-if not pwm_path and gpio_exported:
-    use_hardware_pwm = False
-    pwm_mode = 'software'
-    logger.info("Using software PWM (hardware PWM not available, using sysfs GPIO)")
-elif not pwm_path and not gpio_exported:
-    # Neither hardware PWM nor GPIO export worked
-    # This should not happen as we check gpio_setup_success above, but handle it anyway
-    use_hardware_pwm = False
-    pwm_mode = 'software'
-    logger.warning("Neither hardware PWM nor GPIO export available - service may not function correctly")
-
-logger.info("Fan control service started")
-
-def read_cpu_temp():
-    """Read CPU temperature from thermal zone (compatible with HiFiBerry OS)"""
-    try:
-        with open('/sys/class/thermal/thermal_zone0/temp', 'r') as f:
-            temp_millidegrees = int(f.read().strip())
-            temp_celsius = temp_millidegrees / 1000.0
-            return temp_celsius
-    except (IOError, ValueError) as e:
-        logger.error(f"Failed to read temperature: {e}")
-        return None
-
-def read_config():
-    """Read configuration from JSON file"""
-    global manual_mode, manual_duty_cycle
-    
-    try:
-        if os.path.exists(CONFIG_FILE):
-            with open(CONFIG_FILE, 'r') as f:
-                config = json.load(f)
-                manual_mode = config.get('manual_mode', False)
-                manual_duty_cycle = config.get('manual_duty_cycle', 0)
-                logger.debug(f"Config loaded: manual_mode={manual_mode}, manual_duty_cycle={manual_duty_cycle}")
-                return True
-    except Exception as e:
-        logger.debug(f"Failed to read config file: {e}")
-    return False
+            if self.gpio_pin in PWM_CHANNELS:
+                logger.error(f"GPIO {self.gpio_pin} cannot be exported via sysfs (reserved for PWM)")
+                logger.error("Hardware PWM setup also failed (PWM not available in kernel)")
+            else:
+                logger.error(f"GPIO {self.gpio_pin} export failed")
+            logger.error("")
+            logger.error("Possible solutions:")
+            logger.error(f"1. Check if another service is using GPIO {self.gpio_pin}")
+            logger.error("2. Verify GPIO pin is available: gpioinfo (if gpiod tools installed)")
+            logger.error("3. Check /sys/kernel/debug/gpio for GPIO status")
+            logger.error("")
+            logger.error("To test GPIO manually:")
+            logger.error(f"  echo {self.gpio_pin} > /sys/class/gpio/export")
+            logger.error(f"  ls -la /sys/class/gpio/gpio{self.gpio_pin}")
+        logger.error("=" * 60)
 
-def update_status_file(temp, duty_cycle, mode, error=None):
-    """Update status JSON file for webserver/UI"""
-    global current_temp, current_duty_cycle, pwm_mode
-    current_temp = temp
-    current_duty_cycle = duty_cycle
-    pwm_mode = mode
-    
-    status = {
-        'temperature': round(temp, 1) if temp is not None else None,
-        'duty_cycle': duty_cycle,
-        'pwm_mode': mode,
-        'gpio_pin': GPIO_PIN,
-        'manual_mode': manual_mode,
-        'manual_duty_cycle': manual_duty_cycle if manual_mode else None,
-        'last_update': time.time(),
-        'error': error
-    }
-    
-    try:
-        with open(STATUS_FILE, 'w') as f:
-            json.dump(status, f)
-    except Exception as e:
-        logger.warning(f"Failed to update status file: {e}")
+    def read_cpu_temp_mc(self):
+        """Read CPU temperature in millidegrees Celsius from thermal zone
+        (compatible with HiFiBerry OS)
+        """
+        try:
+            # Keep the sysfs file open and re-read it from offset 0 on every poll
+            if self.temp_fd is None:
+                self.temp_fd = os.open(TEMP_PATH, os.O_RDONLY)
+            return int(os.pread(self.temp_fd, 16, 0))
+        except (IOError, ValueError) as e:
+            logger.error(f"Failed to read temperature: {e}")
+            return None
 
-# Initialize status file after functions are defined
-update_status_file(None, 0, pwm_mode, "Initializing...")
+    def auto_duty_cycle(self, temp_mc):
+        """Auto mode duty cycle with hysteresis
+        Steps up as soon as a threshold is reached, but steps down only when the
+        temperature is TEMP_HYSTERESIS_MC below it and after MIN_DWELL_SECONDS
+        """
+        now = time.monotonic()
+        up = temp_to_duty_cycle(temp_mc)
+        if self.auto_dc is None or up > self.auto_dc:
+            new_dc = up
+        else:
+            new_dc = temp_to_duty_cycle(temp_mc + TEMP_HYSTERESIS_MC)
+            if new_dc < self.auto_dc and now - self.auto_dc_since < MIN_DWELL_SECONDS:
+                new_dc = self.auto_dc
+        if new_dc != self.auto_dc:
+            self.auto_dc = new_dc
+            self.auto_dc_since = now
+        return self.auto_dc
 
-try:
-    while running:
-        # Check for config changes
-        read_config()
-        
-        temp = read_cpu_temp()
-        if temp is None:
-            logger.error("Could not read CPU temperature, retrying in 30 seconds...")
-            update_status_file(None, current_duty_cycle, pwm_mode, "Temperature read failed")
-            time.sleep(30.0)
-            continue
-        
+    def read_config(self):
+        """Read configuration from JSON file"""
         try:
-            temp_rounded = round(temp)
-            
-            # Determine duty cycle based on mode
-            if manual_mode:
-                # Manual override mode
-                dc = manual_duty_cycle
-                sleep_time = 5.0  # Check config more frequently in manual mode
-                logger.info(f"Manual mode: Temp: {temp}°C, Fan: {dc}%")
-            else:
-                # Automatic temperature-based control
-                if temp_rounded >= 50:
-                    dc = 100
-                    sleep_time = 180.0
-                elif temp_rounded >= 40:
-                    dc = 85
-                    sleep_time = 120.0
-                else:
-                    dc = 60
-                    sleep_time = 60.0
-                logger.info(f"Auto mode: Temp: {temp}°C, Fan: {dc}%")
-            
-            # Update status file
-            update_status_file(temp, dc, pwm_mode)
-            
-            # Set PWM duty cycle
-            if use_hardware_pwm:
-                set_hardware_pwm_duty_cycle(pwm_path, dc)
-                time.sleep(sleep_time)
-            elif use_gpiod:
-                # Use gpiod for software PWM (more efficient than sysfs)
-                gpiod_software_pwm(GPIO_PIN, dc, sleep_time)
-            else:
-                software_pwm(GPIO_PIN, dc, sleep_time)
+            if os.path.exists(CONFIG_FILE):
+                with open(CONFIG_FILE, 'rb') as f:
+                    config = _loads(f.read())
+                    manual_mode = bool(config.get('manual_mode', False))
+                    duty_cycle = config.get('manual_duty_cycle', 0)
+                    # The file can be edited by hand, and the duty cycle indexes
+                    # duty_ns_table, so only accept whole numbers within 0-100
+                    if isinstance(duty_cycle, bool) or not isinstance(duty_cycle, (int, float)):
+                        if manual_mode:
+                            logger.warning(f"Invalid manual_duty_cycle {duty_cycle!r} in config, using auto mode")
+                        manual_mode = False
+                        duty_cycle = 0
+                    elif not 0 <= duty_cycle <= 100 or duty_cycle != int(duty_cycle):
+                        clamped = min(max(int(duty_cycle), 0), 100)
+                        logger.warning(f"manual_duty_cycle {duty_cycle} in config is not a whole number within 0-100, using {clamped}")
+                        duty_cycle = clamped
+                    self.manual_mode = manual_mode
+                    self.manual_duty_cycle = int(duty_cycle)
+                    logger.debug(f"Config loaded: manual_mode={self.manual_mode}, manual_duty_cycle={self.manual_duty_cycle}")
+                    return True
         except Exception as e:
-            logger.error(f"Error processing temperature: {e}")
-            update_status_file(current_temp, current_duty_cycle, pwm_mode, str(e))
-            time.sleep(30.0)  # Wait a bit before retrying
-
-except Exception as e:
-    logger.error(f"Unexpected error: {e}", exc_info=True)
-finally:
-    # Cleanup
-    logger.info("Cleaning up GPIO...")
-    if pwm_enabled and pwm_path:
+            logger.debug(f"Failed to read config file: {e}")
+        return False
+
+    def config_event_pending(self):
+        """Check without blocking whether the config file changed"""
+        if self.config_watch_fd is None:
+            return False
+        ready, _, _ = select.select([self.config_watch_fd], [], [], 0)
+        return bool(ready) and self.read_config_events()
+
+    def read_config_events(self):
+        """Drain pending inotify events, return True if the config file changed"""
+        config_name = os.path.basename(CONFIG_FILE).encode()
+        changed = False
+        while True:
+            try:
+                buf = os.read(self.config_watch_fd, 4096)
+            except BlockingIOError:
+                return changed
+            offset = 0
+            while offset < len(buf):
+                _, _, _, name_len = INOTIFY_EVENT.unpack_from(buf, offset)
+                offset += INOTIFY_EVENT.size
+                if buf[offset:offset + name_len].rstrip(b'\0') == config_name:
+                    changed = True
+                offset += name_len
+
+    def update_status_file(self, temp, duty_cycle, mode, error=None):
+        """Update status JSON file for webserver/UI"""
+        self.current_temp = temp
+        self.current_duty_cycle = duty_cycle
+        self.pwm_mode = mode
+
+        payload = (
+            round(temp, 1) if temp is not None else None,
+            duty_cycle,
+            mode,
+            self.gpio_pin,
+            self.manual_mode,
+            self.manual_duty_cycle if self.manual_mode else None,
+            error
+        )
+        # Skip the write (and the SD card wear) if only last_update would change
+        if payload == self.last_status_payload:
+            return
+
+        status = self.status
+        (status['temperature'], status['duty_cycle'], status['pwm_mode'], status['gpio_pin'],
+         status['manual_mode'], status['manual_duty_cycle'], status['error']) = payload
+        status['last_update'] = time.time()
+
         try:
-            with open(f'{pwm_path}/enable', 'w') as f:
-                f.write('0')
-            # Unexport PWM
-            pwmchip_path = os.path.dirname(os.path.dirname(pwm_path))
-            pwm_channel = int(os.path.basename(pwm_path).replace('pwm', ''))
-            with open(f'{pwmchip_path}/unexport', 'w') as f:
-                f.write(str(pwm_channel))
+            # Write a temporary file in one go and rename it so readers never see partial JSON
+            tmp_file = STATUS_FILE + '.tmp'
+            fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                os.write(fd, _dumps(status))
+            finally:
+                os.close(fd)
+            os.rename(tmp_file, STATUS_FILE)
+            self.last_status_payload = payload
         except Exception as e:
-            logger.warning(f"Failed to cleanup PWM: {e}")
-    
-    if use_gpiod and gpio_line:
+            logger.warning(f"Failed to update status file: {e}")
+
+    def run(self):
+        """Main loop: read the temperature and drive the fan until stopped"""
         try:
-            set_gpiod_value(GPIO_PIN, 0)  # Turn off GPIO
-            gpio_line.release()
-            logger.debug("Released gpiod line")
+            while self.running:
+                # Check for config changes (every tick if inotify is not available)
+                if self.config_changed:
+                    self.config_changed = self.config_watch_fd is None
+                    self.read_config()
+
+                self.tick += 1
+                if self.manual_mode and self.tick % MANUAL_TEMP_READ_TICKS and self.last_temp_mc is not None:
+                    temp_mc = self.last_temp_mc
+                else:
+                    temp_mc = self.last_temp_mc = self.read_cpu_temp_mc()
+                    if temp_mc is None:
+                        # Retry quickly after a one-off glitch, back off if it persists
+                        logger.error(f"Could not read CPU temperature, retrying in {self.temp_retry_delay:g} seconds...")
+                        self.update_status_file(None, self.current_duty_cycle, self.pwm_mode, "Temperature read failed")
+                        self.wait(self.temp_retry_delay)
+                        self.temp_retry_delay = min(self.temp_retry_delay * 2, TEMP_RETRY_MAX_DELAY)
+                        continue
+                    self.temp_retry_delay = 1.0
+
+                try:
+                    temp = temp_mc / 1000.0  # For logging and status only
+
+                    # Determine duty cycle based on mode
+                    if self.manual_mode:
+                        # Manual override mode
+                        dc = self.manual_duty_cycle
+                        sleep_time = 5.0  # Check config more frequently in manual mode
+                        logger.info(f"Manual mode: Temp: {temp}°C, Fan: {dc}%")
+                    else:
+                        # Automatic temperature-based control
+                        dc = self.auto_duty_cycle(temp_mc)
+                        if dc == 100:
+                            sleep_time = 180.0
+                        elif dc == 85:
+                            sleep_time = 120.0
+                        else:
+                            sleep_time = 60.0
+                        logger.info(f"Auto mode: Temp: {temp}°C, Fan: {dc}%")
+
+                    # Update status file
+                    self.update_status_file(temp, dc, self.pwm_mode)
+
+                    # Set PWM duty cycle
+                    # Hardware and pigpio PWM keep running on their own, so only
+                    # write the duty cycle when it actually changes
+                    if self.use_hardware_pwm:
+                        if dc != self.last_dc and self.set_hardware_pwm_duty_cycle(dc):
+                            self.last_dc = dc
+                        self.wait(sleep_time)
+                    elif self.pigpio_pi:
+                        if dc != self.last_dc and self.set_pigpio_duty_cycle(self.gpio_pin, dc):
+                            self.last_dc = dc
+                        self.wait(sleep_time)
+                    elif self.use_gpiod:
+                        # Use gpiod for software PWM (more efficient than sysfs)
+                        self.gpiod_software_pwm(self.gpio_pin, dc, sleep_time)
+                    else:
+                        self.software_pwm(self.gpio_pin, dc, sleep_time)
+                except Exception as e:
+                    logger.error(f"Error processing temperature: {e}")
+                    self.update_status_file(self.current_temp, self.current_duty_cycle, self.pwm_mode, str(e))
+                    self.wait(30.0)  # Wait a bit before retrying
+
         except Exception as e:
-            logger.warning(f"Failed to cleanup gpiod: {e}")
-    elif gpio_exported:
-        set_gpio_value(GPIO_PIN, 0)  # Turn off GPIO
-        unexport_gpio(GPIO_PIN)
-    
-    # Final status update
-    update_status_file(current_temp, 0, pwm_mode, "Service stopped")
-    logger.info("Fan control service stopped")
+            logger.error(f"Unexpected error: {e}", exc_info=True)
+
+    def cleanup(self):
+        """Turn the fan off and release the GPIO, PWM and file descriptors"""
+        logger.info("Cleaning up GPIO...")
+        for fd in (self.temp_fd, self.duty_fd, self.config_watch_fd):
+            if fd is not None:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+        self.temp_fd = self.duty_fd = self.config_watch_fd = None
+
+        if self.pwm_enabled and self.pwm_path:
+            try:
+                with open(f'{self.pwm_path}/enable', 'w') as f:
+                    f.write('0')
+                # Unexport PWM
+                pwmchip_path = os.path.dirname(self.pwm_path)
+                pwm_channel = int(os.path.basename(self.pwm_path).replace('pwm', ''))
+                with open(f'{pwmchip_path}/unexport', 'w') as f:
+                    f.write(str(pwm_channel))
+            except Exception as e:
+                logger.warning(f"Failed to cleanup PWM: {e}")
+
+        if self.pigpio_pi:
+            try:
+                self.pigpio_pi.set_PWM_dutycycle(self.gpio_pin, 0)
+                self.pigpio_pi.stop()
+            except Exception as e:
+                logger.warning(f"Failed to stop pigpio PWM: {e}")
+        elif self.use_gpiod and self.gpio_line:
+            try:
+                self.set_gpiod_value(self.gpio_pin, 0)  # Turn off GPIO
+                self.gpio_line.release()
+                logger.debug("Released gpiod line")
+            except Exception as e:
+                logger.warning(f"Failed to cleanup gpiod: {e}")
+        elif self.gpio_exported:
+            if self.value_fd is not None:
+                self.set_gpio_value(self.gpio_pin, 0)  # Turn off GPIO
+                os.close(self.value_fd)
+                self.value_fd = None
+            unexport_gpio(self.gpio_pin)
+
+        # Final status update
+        self.update_status_file(self.current_temp, 0, self.pwm_mode, "Service stopped")
+
+        signal.set_wakeup_fd(-1)
+        for fd in (self.wakeup_r, self.wakeup_w):
+            if fd is not None:
+                os.close(fd)
+        self.wakeup_r = self.wakeup_w = None
+        logger.info("Fan control service stopped")
+
+def main():
+    with FanController() as controller:
+        controller.run()
+
+if __name__ == '__main__':
+    main()